@@ -1,14 +1,33 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+from collections import deque
 import os
+import threading
+import time
 from dotenv import load_dotenv
 from flask_cors import CORS
 
 load_dotenv()
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Total-Count', 'X-Total-Count-Estimated', 'Retry-After'])
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# ADMISSION_TIMEOUT is the whole budget before a 503: the pool wait is capped at half of it
+# and the admission queue gets the rest, so a request never waits longer than ADMISSION_TIMEOUT
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', 2))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = min(float(os.getenv('DB_POOL_TIMEOUT', ADMISSION_TIMEOUT / 2)), ADMISSION_TIMEOUT / 2)
+ADMISSION_QUEUE_TIMEOUT = ADMISSION_TIMEOUT - DB_POOL_TIMEOUT
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': DB_POOL_SIZE,
+    'max_overflow': DB_MAX_OVERFLOW,
+    'pool_timeout': DB_POOL_TIMEOUT
+}
 db = SQLAlchemy(app)
 
 # Models
@@ -174,11 +193,260 @@ class Record(db.Model):
         }
 
 
+# Admission control
+class AdmissionGate:
+    """Concurrency limit with a bounded FIFO wait queue for one class of routes."""
+
+    def __init__(self, name, limit, max_queue, timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.active = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.pool_timeouts = 0
+        self.waiters = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.active < self.limit and not self.waiters:
+                self.active += 1
+                self.admitted += 1
+                return True
+            if len(self.waiters) >= self.max_queue:
+                self.shed += 1
+                return False
+            waiter = threading.Event()
+            self.waiters.append(waiter)
+            self.queued += 1
+        if waiter.wait(self.timeout):
+            return True
+        with self.lock:
+            # The slot may have been handed over between the timeout and taking the lock
+            if waiter.is_set():
+                return True
+            self.waiters.remove(waiter)
+            self.shed += 1
+            return False
+
+    def release(self):
+        with self.lock:
+            if self.waiters:
+                # Hand the slot straight to the oldest waiter so newcomers can't jump the queue
+                self.admitted += 1
+                self.waiters.popleft().set()
+            else:
+                self.active -= 1
+
+    def record_pool_timeout(self):
+        with self.lock:
+            self.pool_timeouts += 1
+
+    def serialize(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'limit': self.limit,
+                'max_queue': self.max_queue,
+                'active': self.active,
+                'waiting': len(self.waiters),
+                'admitted': self.admitted,
+                'queued': self.queued,
+                'shed': self.shed,
+                'pool_timeouts': self.pool_timeouts
+            }
+
+RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+
+# Every admitted request holds at most one pooled connection, so the gate limits together
+# (including analytics, which a count fallback can take on top of a read slot) must fit in
+# pool_size + max_overflow. Admitted reads then never queue for a connection behind scans.
+gates = {
+    'read': AdmissionGate('read', int(os.getenv('ADMISSION_READ_LIMIT', 12)),
+                          int(os.getenv('ADMISSION_READ_QUEUE', 32)), ADMISSION_QUEUE_TIMEOUT),
+    'write': AdmissionGate('write', int(os.getenv('ADMISSION_WRITE_LIMIT', 4)),
+                           int(os.getenv('ADMISSION_WRITE_QUEUE', 16)), ADMISSION_QUEUE_TIMEOUT),
+    'analytics': AdmissionGate('analytics', int(os.getenv('ADMISSION_ANALYTICS_LIMIT', 2)),
+                               int(os.getenv('ADMISSION_ANALYTICS_QUEUE', 4)), ADMISSION_QUEUE_TIMEOUT)
+}
+
+if sum(gate.limit for gate in gates.values()) > DB_POOL_SIZE + DB_MAX_OVERFLOW:
+    raise ValueError(
+        'Admission limits ({}) exceed the DB pool capacity ({} + {} overflow)'.format(
+            sum(gate.limit for gate in gates.values()), DB_POOL_SIZE, DB_MAX_OVERFLOW))
+
+# Full-table scans over the largest tables (estimated counts stay on the read budget)
+ANALYTICS_ENDPOINTS = {'records', 'patient_diseases'}
+UNGATED_ENDPOINTS = {'admission_stats', 'static'}
+
+def gate_for_request():
+    if request.method in ('POST', 'PUT', 'DELETE'):
+        return gates['write']
+    if request.endpoint in ANALYTICS_ENDPOINTS and count_mode() != 'estimated':
+        return gates['analytics']
+    return gates['read']
+
+def overloaded():
+    return jsonify({'message': 'Server busy, retry later'}), 503, {'Retry-After': str(RETRY_AFTER)}
+
+@app.before_request
+def admit_request():
+    if request.method == 'OPTIONS' or request.endpoint is None or request.endpoint in UNGATED_ENDPOINTS:
+        return None
+    gate = gate_for_request()
+    if not gate.acquire():
+        return overloaded()
+    g.admission_gate = gate
+    return None
+
+@app.teardown_request
+def release_request(exc):
+    gate = g.pop('admission_gate', None)
+    if gate is not None:
+        gate.release()
+
+@app.errorhandler(PoolTimeoutError)
+def pool_timeout(error):
+    db.session.rollback()
+    gate = g.get('admission_gate')
+    if gate is not None:
+        gate.record_pool_timeout()
+    return overloaded()
+
+@app.route('/api/admission/', methods=['GET'])
+def admission_stats():
+    return jsonify([gate.serialize() for gate in gates.values()])
+
+# Collection counts
+COUNT_MODES = ('', 'estimated', 'exact')
+EXACT_COUNT_TTL = float(os.getenv('EXACT_COUNT_TTL', 30))
+table_versions = {}
+exact_counts = {}
+counts_lock = threading.Lock()
+
+# Tables whose rows the database deletes/updates when a row of the key table changes
+cascade_children = {}
+for child in db.metadata.tables.values():
+    for fk in child.foreign_keys:
+        if fk.ondelete == 'CASCADE' or fk.onupdate == 'CASCADE':
+            cascade_children.setdefault(fk.column.table.name, set()).add(child.name)
+
+def with_cascades(tables):
+    affected = set()
+    pending = list(tables)
+    while pending:
+        table = pending.pop()
+        if table not in affected:
+            affected.add(table)
+            pending.extend(cascade_children.get(table, ()))
+    return affected
+
+@event.listens_for(Session, 'after_flush')
+def track_changed_tables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        changed.add(obj.__table__.name)
+
+@event.listens_for(Session, 'after_commit')
+def bump_table_versions(session):
+    changed = with_cascades(session.info.pop('changed_tables', set()))
+    with counts_lock:
+        for table in changed:
+            table_versions[table] = table_versions.get(table, 0) + 1
+
+@event.listens_for(Session, 'after_rollback')
+def discard_changed_tables(session):
+    session.info.pop('changed_tables', None)
+
+def count_mode():
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    if request.method == 'HEAD' or 'count' in request.args:
+        return 'exact' if request.args.get('count') == 'exact' else 'estimated'
+    return None
+
+def table_stats(model):
+    # The pg_stat write counters are the second half of the cache version: they pick up
+    # other workers and external writers, but only once those backends flush their stats
+    row = db.session.execute(
+        text("""
+            SELECT c.reltuples::bigint,
+                   s.n_tup_ins + s.n_tup_upd + s.n_tup_del
+            FROM pg_class c
+            LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+            WHERE c.oid = to_regclass(:table)
+        """),
+        {'table': model.__table__.name}
+    ).first()
+    if row is None:
+        return None, None
+    # reltuples is -1 (or 0 on older servers) until the table has been vacuumed/analyzed
+    estimate = row[0] if row[0] is not None and row[0] > 0 else None
+    return estimate, row[1]
+
+def count_version(table, stats_version):
+    # Commits from this process (including FK cascades) invalidate immediately. Writes from
+    # other workers or outside the app are seen after the stats flush (about a second);
+    # TRUNCATE and pg_stat_reset() don't move the counters, so those are bounded by the TTL.
+    with counts_lock:
+        return table_versions.get(table, 0), stats_version
+
+def cached_exact_count(model, stats_version):
+    table = model.__table__.name
+    version = count_version(table, stats_version)
+    with counts_lock:
+        cached = exact_counts.get(table)
+    if cached is not None and cached[0] == version and time.monotonic() - cached[2] < EXACT_COUNT_TTL:
+        return cached[1]
+    return None
+
+def exact_count(model, stats_version):
+    total = cached_exact_count(model, stats_version)
+    if total is not None:
+        return total
+    table = model.__table__.name
+    version = count_version(table, stats_version)
+    total = db.session.query(func.count()).select_from(model).scalar()
+    with counts_lock:
+        exact_counts[table] = (version, total, time.monotonic())
+    return total
+
+def count_response(model):
+    if request.args.get('count', '') not in COUNT_MODES:
+        return jsonify({'message': "count must be 'estimated' or 'exact'"}), 400
+    estimate, version = table_stats(model)
+    estimated = count_mode() == 'estimated' and estimate is not None
+    if estimated:
+        total = estimate
+    elif count_mode() == 'estimated' and request.endpoint in ANALYTICS_ENDPOINTS:
+        # No statistics yet: only an actual COUNT(*) scan needs an analytics slot
+        total = cached_exact_count(model, version)
+        if total is None:
+            gate = gates['analytics']
+            if not gate.acquire():
+                return overloaded()
+            try:
+                total = exact_count(model, version)
+            finally:
+                gate.release()
+    else:
+        total = exact_count(model, version)
+    headers = {
+        'X-Total-Count': str(total),
+        'X-Total-Count-Estimated': 'true' if estimated else 'false'
+    }
+    return jsonify({'count': total, 'estimated': estimated}), 200, headers
+
 # CRUD Operations
 # Country CRUD
 @app.route('/api/countries/', methods=['GET', 'POST'])
 def countries():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Country)
+    elif request.method == 'GET':
         countries = Country.query.all()
         return jsonify([country.serialize() for country in countries])
     elif request.method == 'POST':
@@ -208,7 +476,9 @@ def country(cname):
 # Users CRUD
 @app.route('/api/users/', methods=['GET', 'POST'])
 def users():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Users)
+    elif request.method == 'GET':
         users = Users.query.all()
         return jsonify([user.serialize() for user in users])
     elif request.method == 'POST':
@@ -247,7 +517,9 @@ def user(email):
 # Doctor CRUD
 @app.route('/api/doctors/', methods=['GET', 'POST'])
 def doctors():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Doctor)
+    elif request.method == 'GET':
         doctors = Doctor.query.all()
         return jsonify([doctor.serialize() for doctor in doctors])
     elif request.method == 'POST':
@@ -277,7 +549,9 @@ def doctor(email):
 # PublicServant CRUD
 @app.route('/api/public-servants/', methods=['GET', 'POST'])
 def public_servants():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(PublicServant)
+    elif request.method == 'GET':
         public_servants = PublicServant.query.all()
         return jsonify([public_servant.serialize() for public_servant in public_servants])
     elif request.method == 'POST':
@@ -307,7 +581,9 @@ def public_servant(email):
 # Patients CRUD
 @app.route('/api/patients/', methods=['GET', 'POST'])
 def patients():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Patients)
+    elif request.method == 'GET':
         patients = Patients.query.all()
         return jsonify([patient.serialize() for patient in patients])
     elif request.method == 'POST':
@@ -335,7 +611,9 @@ def patient(email):
 # DiseaseType CRUD
 @app.route('/api/disease-types/', methods=['GET', 'POST'])
 def disease_types():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(DiseaseType)
+    elif request.method == 'GET':
         disease_types = DiseaseType.query.all()
         return jsonify([disease_type.serialize() for disease_type in disease_types])
     elif request.method == 'POST':
@@ -365,7 +643,9 @@ def disease_type(id):
 # Specialize CRUD
 @app.route('/api/specializations/', methods=['GET', 'POST'])
 def specializations():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Specialize)
+    elif request.method == 'GET':
         specializations = Specialize.query.all()
         return jsonify([specialization.serialize() for specialization in specializations])
     elif request.method == 'POST':
@@ -395,7 +675,9 @@ def specialization(id, email):
 # Disease CRUD
 @app.route('/api/diseases/', methods=['GET', 'POST'])
 def diseases():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Disease)
+    elif request.method == 'GET':
         diseases = Disease.query.all()
         return jsonify([disease.serialize() for disease in diseases])
     elif request.method == 'POST':
@@ -429,7 +711,9 @@ def disease(disease_code):
 # Discover CRUD
 @app.route('/api/discoveries/', methods=['GET', 'POST'])
 def discoveries():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Discover)
+    elif request.method == 'GET':
         discoveries = Discover.query.all()
         return jsonify([discovery.serialize() for discovery in discoveries])
     elif request.method == 'POST':
@@ -461,7 +745,9 @@ def discovery(disease_code):
 # PatientDisease CRUD
 @app.route('/api/patient-diseases/', methods=['GET', 'POST'])
 def patient_diseases():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(PatientDisease)
+    elif request.method == 'GET':
         patient_diseases = PatientDisease.query.all()
         return jsonify([patient_disease.serialize() for patient_disease in patient_diseases])
     elif request.method == 'POST':
@@ -491,7 +777,9 @@ def patient_disease(email, disease_code):
 # Record CRUD
 @app.route('/api/records/', methods=['GET', 'POST'])
 def records():
-    if request.method == 'GET':
+    if count_mode():
+        return count_response(Record)
+    elif request.method == 'GET':
         records = Record.query.all()
         return jsonify([record.serialize() for record in records])
     elif request.method == 'POST':
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Always a throwaway SQLite file, never whatever DATABASE_URL the shell has exported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+
+@pytest.fixture(scope='session', autouse=True)
+def tables():
+    from app import app, db
+    with app.app_context():
+        db.create_all()
@@ -0,0 +1,109 @@
+import threading
+import time
+
+import app as app_module
+from app import AdmissionGate
+
+
+def acquire_in_thread(gate):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(gate.acquire()))
+    thread.start()
+    return thread, results
+
+
+def wait_for_waiters(gate, count):
+    deadline = time.monotonic() + 1
+    while len(gate.waiters) < count and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert len(gate.waiters) == count
+
+
+def test_fast_admit():
+    gate = AdmissionGate('read', 2, 1, 0.1)
+    assert gate.acquire()
+    assert gate.acquire()
+    stats = gate.serialize()
+    assert stats['active'] == 2
+    assert stats['admitted'] == 2
+    assert stats['queued'] == 0
+
+
+def test_queues_up_to_max_queue_then_sheds():
+    gate = AdmissionGate('read', 1, 2, 1)
+    assert gate.acquire()
+    threads = [acquire_in_thread(gate) for _ in range(2)]
+    wait_for_waiters(gate, 2)
+
+    assert not gate.acquire()
+    assert gate.serialize()['shed'] == 1
+    assert gate.serialize()['queued'] == 2
+
+    gate.release()
+    gate.release()
+    for thread, results in threads:
+        thread.join()
+        assert results == [True]
+
+
+def test_sheds_after_deadline():
+    gate = AdmissionGate('read', 1, 1, 0.05)
+    assert gate.acquire()
+    started = time.monotonic()
+    assert not gate.acquire()
+    assert time.monotonic() - started >= 0.05
+    stats = gate.serialize()
+    assert stats['queued'] == 1
+    assert stats['shed'] == 1
+    assert stats['waiting'] == 0
+
+
+def test_release_wakes_waiter_before_newcomers():
+    gate = AdmissionGate('read', 1, 1, 1)
+    assert gate.acquire()
+    thread, results = acquire_in_thread(gate)
+    wait_for_waiters(gate, 1)
+
+    gate.release()
+    thread.join()
+    assert results == [True]
+    # The slot went to the waiter, so a newcomer has to queue rather than take it
+    assert gate.serialize()['active'] == 1
+    gate.timeout = 0.01
+    assert not gate.acquire()
+    assert gate.serialize()['admitted'] == 2
+
+
+def test_full_gate_returns_503_with_retry_after(monkeypatch):
+    gate = AdmissionGate('read', 1, 0, 0.01)
+    monkeypatch.setitem(app_module.gates, 'read', gate)
+    assert gate.acquire()
+
+    response = app_module.app.test_client().get('/api/countries/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app_module.RETRY_AFTER)
+    assert gate.serialize()['shed'] == 1
+
+
+def test_pool_timeout_returns_503_and_is_counted(monkeypatch):
+    gate = AdmissionGate('read', 1, 0, 0.01)
+    monkeypatch.setitem(app_module.gates, 'read', gate)
+
+    def exhausted_pool():
+        raise app_module.PoolTimeoutError('QueuePool limit reached')
+    monkeypatch.setitem(app_module.app.view_functions, 'countries', exhausted_pool)
+
+    response = app_module.app.test_client().get('/api/countries/')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app_module.RETRY_AFTER)
+    stats = gate.serialize()
+    assert stats['pool_timeouts'] == 1
+    assert stats['admitted'] == 1
+    assert stats['shed'] == 0
+    assert stats['active'] == 0
+
+
+def test_gate_limits_fit_pool_and_deadline():
+    assert sum(gate.limit for gate in app_module.gates.values()) <= \
+        app_module.DB_POOL_SIZE + app_module.DB_MAX_OVERFLOW
+    assert app_module.ADMISSION_QUEUE_TIMEOUT + app_module.DB_POOL_TIMEOUT <= app_module.ADMISSION_TIMEOUT
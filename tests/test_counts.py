@@ -0,0 +1,112 @@
+import pytest
+from sqlalchemy import event
+
+import app as app_module
+from app import app, db, AdmissionGate, Country
+
+
+@pytest.fixture(autouse=True)
+def empty_count_cache():
+    app_module.exact_counts.clear()
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    # Stand-in for the pg_class/pg_stat_user_tables lookup, which SQLite doesn't have
+    current = {'estimate': None, 'version': 1}
+    monkeypatch.setattr(app_module, 'table_stats', lambda model: (current['estimate'], current['version']))
+    return current
+
+
+@pytest.fixture
+def count_queries():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'count(' in statement.lower():
+            statements.append(statement)
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', record)
+
+
+def test_post_with_count_param_still_inserts():
+    response = app.test_client().post('/api/countries/?count=exact',
+                                      json={'cname': 'Kazakhstan', 'population': 20000000})
+    assert response.status_code == 201
+    with app.app_context():
+        assert db.session.get(Country, 'Kazakhstan') is not None
+
+
+def test_invalid_count_mode_is_rejected():
+    for value in ('bogus', 'false'):
+        response = app.test_client().get('/api/countries/?count=' + value)
+        assert response.status_code == 400
+
+
+def test_cors_exposes_count_headers():
+    response = app.test_client().get('/api/admission/', headers={'Origin': 'http://example.com'})
+    exposed = response.headers['Access-Control-Expose-Headers']
+    for header in ('X-Total-Count', 'X-Total-Count-Estimated', 'Retry-After'):
+        assert header in exposed
+
+
+def test_estimated_count_comes_from_statistics(stats):
+    stats['estimate'] = 123
+    response = app.test_client().head('/api/countries/')
+    assert response.status_code == 200
+    assert response.headers['X-Total-Count'] == '123'
+    assert response.headers['X-Total-Count-Estimated'] == 'true'
+
+
+def test_exact_count_is_cached_per_version(stats, count_queries):
+    client = app.test_client()
+    first = client.get('/api/countries/?count=exact')
+    assert first.headers['X-Total-Count-Estimated'] == 'false'
+    assert first.get_json() == {'count': int(first.headers['X-Total-Count']), 'estimated': False}
+    client.get('/api/countries/?count=exact')
+    assert len(count_queries) == 1
+
+    stats['version'] = 2
+    client.get('/api/countries/?count=exact')
+    assert len(count_queries) == 2
+
+
+def test_commit_in_this_process_invalidates_exact_count(stats):
+    client = app.test_client()
+    before = int(client.get('/api/countries/?count=exact').headers['X-Total-Count'])
+    client.post('/api/countries/', json={'cname': 'Uzbekistan', 'population': 36000000})
+    after = int(client.get('/api/countries/?count=exact').headers['X-Total-Count'])
+    assert after == before + 1
+
+
+def test_delete_bumps_cascading_tables(stats):
+    client = app.test_client()
+    client.post('/api/countries/', json={'cname': 'Kyrgyzstan', 'population': 7000000})
+    versions = dict(app_module.table_versions)
+    client.delete('/api/countries/Kyrgyzstan')
+    for table in ('country', 'users', 'record', 'patientdisease'):
+        assert app_module.table_versions[table] == versions.get(table, 0) + 1
+
+
+def test_missing_statistics_fallback_takes_analytics_slot(stats, monkeypatch):
+    gate = AdmissionGate('analytics', 1, 0, 0.01)
+    monkeypatch.setitem(app_module.gates, 'analytics', gate)
+    client = app.test_client()
+
+    response = client.head('/api/records/')
+    assert response.status_code == 200
+    assert response.headers['X-Total-Count-Estimated'] == 'false'
+    assert gate.serialize()['admitted'] == 1
+
+    # A cached count needs no scan, so it doesn't take (or wait for) an analytics slot
+    assert gate.acquire()
+    assert client.head('/api/records/').status_code == 200
+    assert gate.serialize()['admitted'] == 2
+
+    app_module.exact_counts.clear()
+    response = client.head('/api/records/')
+    assert response.status_code == 503
+    assert gate.serialize()['shed'] == 1